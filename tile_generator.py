@@ -1,8 +1,11 @@
 # System
+import functools
 import json
 import multiprocessing
+import operator
 import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 # Advanced
 import xml.etree.ElementTree as ET
@@ -10,7 +13,6 @@ from argparse import ArgumentParser
 from pathlib import Path
 import pandas as pd
 import cv2
-import matplotlib.pyplot as plt
 
 # Numpy
 import numpy as np
@@ -31,18 +33,70 @@ except Exception as e:
 # noinspection PyPep8
 import openslide
 
+# libvips is optional and only used for faster region reads, openslide is used if it is not installed
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+# orjson is optional and only used for faster metadata export, the json module is used if it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# numba is optional and only used to compute the label coverage of all patches of a tile in one compiled loop, the numpy
+# implementation in WSIHandler.calculate_label_percentages is used if it is not installed
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:
+    njit = None
+    prange = range
+    set_num_threads = None
+
 # Custom
 # noinspection PyPep8
 import tissue_detection
 
 _MULTIPROCESS = True
 
+_THRESHOLD_OPERATORS = {"==": operator.eq, ">=": operator.ge, ">": operator.gt, "<=": operator.le, "<": operator.lt}
+
+# png: the lowest compression level encodes several times faster than the default at slightly larger file sizes
+# jpeg: higher quality than the Pillow default of 75, jpeg encoding is still much faster than png
+_SAVE_OPTIONS = {"png": {"compress_level": 1}, "jpeg": {"quality": 90}}
+
+
+def _count_patch_labels(annotation_mask, patch_size_px_y, patch_size_px_x, patch_ys, patch_xs):
+    # counts the annotated pixels per label and the unannotated pixels (label 0) of every patch in a single pass over
+    # the patch pixels, the patch rows are processed in parallel
+    label_counts = np.zeros(shape=(annotation_mask.shape[2], patch_ys.shape[0], patch_xs.shape[0]), dtype=np.int64)
+    for row in prange(patch_ys.shape[0]):
+        for col in range(patch_xs.shape[0]):
+            for y in range(patch_ys[row], patch_ys[row] + patch_size_px_y):
+                for x in range(patch_xs[col], patch_xs[col] + patch_size_px_x):
+                    unannotated = True
+                    for label_id in range(1, annotation_mask.shape[2]):
+                        if annotation_mask[y, x, label_id] != 0:
+                            label_counts[label_id, row, col] += 1
+                            unannotated = False
+                    if unannotated:
+                        label_counts[0, row, col] += 1
+    return label_counts
+
+
+if njit is not None:
+    _count_patch_labels = njit(parallel=True, cache=True)(_count_patch_labels)
+
 global lock
 
 
 class WSIHandler:
     def __init__(self, config_path="resources/config.json"):
         self.slide = None
+        self.vips_image = None
+        self.vips_region = None
+        self.tissue_detection_image = None
         self.output_path = None
         self.total_width = 0
         self.total_height = 0
@@ -82,6 +136,13 @@ class WSIHandler:
                                                     f"first position in config.label_dict. Please move the unannotated "
                                                     f"tissue type '{label}' to the first position.")
 
+    def get_threads_per_process(self):
+        # slides2patches already starts one pool process per available thread, so each process only gets a single
+        # thread for its patch writers and the numba kernel, without multiprocessing they may use all available threads
+        if _MULTIPROCESS:
+            return 1
+        return max(1, multiprocessing.cpu_count() - self.config["blocked_threads"])
+
     def print_and_log_slide_error(self, slide_name, error_msg, method_name):
         print(f"Error in slide {slide_name}. The error is: {type(error_msg).__name__}: {error_msg} in method: "
               f"{method_name}.")
@@ -111,6 +172,18 @@ class WSIHandler:
         self.total_height = self.slide.dimensions[1]
         self.levels = self.slide.level_count - 1
 
+        self.vips_image = None
+        self.vips_region = None
+        if pyvips is not None:
+            try:
+                # random access, as the tiles are not necessarily read from top to bottom
+                self.vips_image = pyvips.Image.openslideload(slide_path, level=0)
+                self.vips_region = pyvips.Region.new(self.vips_image)
+            except pyvips.Error:
+                # e.g. libvips builds without openslide support, the tiles are read via openslide instead
+                self.vips_image = None
+                self.vips_region = None
+
         processing_level = self.config["processing_level"]
 
         if self.levels < self.config["processing_level"]:
@@ -128,7 +201,11 @@ class WSIHandler:
 
         return processing_level
 
-    def load_annotation(self, annotation_path):
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def load_annotation(annotation_path, label_names):
+        # only the last annotation is cached, which only helps when the same slide is processed again in one process.
+        # label_names is a tuple of the label_dict keys to keep the arguments hashable
         annotation_dict = {}
         file_format = Path(annotation_path).suffix
 
@@ -140,7 +217,7 @@ class WSIHandler:
             for polygon_nb in range(len(annotations["features"])):
                 if annotations["features"][polygon_nb]["geometry"]["type"] == "Polygon":
                     if (annotations["features"][polygon_nb]["properties"]["classification"]["name"] in
-                            self.config["label_dict"].keys()):
+                            label_names):
                         annotation_dict.update({polygon_nb: {
                             "coordinates": annotations["features"][polygon_nb]["geometry"]["coordinates"][0],
                             "tissue_type": annotations["features"][polygon_nb]["properties"]["classification"][
@@ -149,7 +226,7 @@ class WSIHandler:
                         warnings.warn(f'Unknown annotation type in file {annotation_file.name}: The annotation label '
                                       f'"{annotations["features"][polygon_nb]["properties"]["classification"]["name"]}"'
                                       f' is not part of the provided label dictionary '
-                                      f'(keys: {list(self.config["label_dict"].keys())}. Skipping.')
+                                      f'(keys: {list(label_names)}. Skipping.')
                 else:
                     warnings.warn(f'Not implemented warning in file {annotation_file.name}: The handling of the QuPath '
                                   f'annotation type {annotations["features"][polygon_nb]["geometry"]["type"]} '
@@ -178,6 +255,47 @@ class WSIHandler:
 
         return annotation_dict
 
+    def read_tile(self, tile_x, tile_y, tile_size):
+        if self.vips_region is None:
+            # Pillow's array interface already copies the pixels via tobytes(), np.asarray avoids the second copy
+            # np.array would make on top of it. Dropping the alpha channel is a view, the tile is read-only, which is
+            # fine as it is only sliced into patches.
+            tile = np.asarray(self.slide.read_region((tile_x, tile_y), level=0, size=(tile_size, tile_size)))
+            return tile[:, :, 0:3]
+
+        # libvips can only fetch areas inside the slide, whereas openslide pads areas outside the slide with zeros. The
+        # padding is replicated here for tiles at the right and bottom border.
+        width = min(tile_size, self.total_width - tile_x)
+        height = min(tile_size, self.total_height - tile_y)
+        if width == tile_size and height == tile_size:
+            return self.fetch_vips_region(tile_x, tile_y, tile_size, tile_size)
+
+        tile = np.zeros(shape=(tile_size, tile_size, 3), dtype=np.uint8)
+        if width > 0 and height > 0:
+            tile[:height, :width] = self.fetch_vips_region(tile_x, tile_y, width, height)
+        return tile
+
+    def fetch_vips_region(self, x, y, width, height):
+        region = np.ndarray(buffer=self.vips_region.fetch(x, y, width, height), dtype=np.uint8,
+                            shape=(height, width, self.vips_image.bands))
+        if self.vips_image.bands == 4:
+            # libvips fills transparent pixels with the slide's background color, openslide returns them as zeros. The
+            # zeros are restored, so that empty patches are skipped the same way for both backends.
+            return np.where(region[:, :, 3:4] == 0, np.uint8(0), region[:, :, 0:3])
+        return region[:, :, 0:3]
+
+    def read_tiles(self, tile_coordinates):
+        # the next tile is read in a background thread while the current one is processed
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            current_tile = None
+            for tile_x, tile_y, tile_size in tile_coordinates:
+                next_tile = reader.submit(self.read_tile, tile_x, tile_y, tile_size)
+                if current_tile is not None:
+                    yield current_tile.result()
+                current_tile = next_tile
+            if current_tile is not None:
+                yield current_tile.result()
+
     def get_img(self, level=None, show=False):
         if level is None:
             level = self.levels
@@ -186,6 +304,9 @@ class WSIHandler:
         image = np.array(self.slide.read_region((0, 0), level, dims))
 
         if show:
+            # matplotlib is only imported when plotting, as the import is slow and not needed otherwise
+            import matplotlib.pyplot as plt
+
             # Katja: fix for Wayland issue on my Ubuntu:
             # run 'export QT_QPA_PLATFORM=xcb' before opening pycharm (in the same terminal)
             plt.imshow(image)
@@ -196,14 +317,33 @@ class WSIHandler:
 
     def apply_tissue_detection(self, level=None, show=False):
 
+        if level is not None and not 0 <= level < self.slide.level_count:
+            valid_level = min(max(level, 0), self.slide.level_count - 1)
+            print("###############################################")
+            print(
+                "WARNING: Tissue detection level "
+                + str(level)
+                + " is not available, the slide has "
+                + str(self.slide.level_count)
+                + " levels. Setting tissue detection level to "
+                + str(valid_level)
+            )
+            print("###############################################")
+            level = valid_level
+
         if level is not None:
             image, level = self.get_img(level, show)
         else:
             image, level = self.get_img(show=show)
 
         tissue_mask = tissue_detection.tissue_detection(image, remove_top_percentage=0)
+        # tissue_detection leaves the image unchanged, so it is kept for the thumbnail instead of reading the whole
+        # level a second time
+        self.tissue_detection_image = image
 
         if show:
+            import matplotlib.pyplot as plt
+
             plt.imshow(tissue_mask)
             plt.title("Tissue Mask")
             plt.show()
@@ -226,6 +366,37 @@ class WSIHandler:
 
         return tile_size
 
+    @staticmethod
+    def count_nonzero_per_tile(mask, tile_size, rows, cols):
+        # summed-area table: the number of nonzero pixels of a tile is given by its four corners. Corners beyond the
+        # mask are clamped to the mask border, which takes care of the partial tiles at the right and bottom border.
+        integral = cv2.integral((mask != 0).view(np.uint8))
+        row_bounds = np.minimum(np.arange(rows + 1) * tile_size, mask.shape[0])
+        col_bounds = np.minimum(np.arange(cols + 1) * tile_size, mask.shape[1])
+        corners = integral[np.ix_(row_bounds, col_bounds)]
+        return corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+
+    @staticmethod
+    def show_relevant_tiles(tissue_mask, relevant_tiles_dict, tile_size):
+        import matplotlib.pyplot as plt
+
+        # only needed for plotting, so the RGB copy of the mask is not created otherwise
+        colored = cv2.cvtColor(tissue_mask, cv2.COLOR_GRAY2RGB)
+        for tile in relevant_tiles_dict.values():
+            # annotated tiles in green, others in red
+            color, thickness = ((0, 255, 0), 3) if tile["annotated"] else ((255, 0, 0), 1)
+            colored = cv2.rectangle(
+                colored,
+                (tile["x"], tile["y"]),
+                (tile["x"] + tile_size, tile["y"] + tile_size),
+                color,
+                thickness,
+            )
+
+        plt.imshow(colored)
+        plt.title("Tiled image")
+        plt.show()
+
     def get_relevant_tiles(self, tissue_mask, tile_size, min_coverage, level, show=False):
 
         rows, row_residue = divmod(tissue_mask.shape[0], tile_size)
@@ -236,11 +407,14 @@ class WSIHandler:
         if col_residue:
             cols += 1
 
-        if self.config["use_tissue_detection"]:
-            colored = cv2.cvtColor(tissue_mask, cv2.COLOR_GRAY2RGB)
+        # border tiles are smaller than tile_size, so their coverage is computed w.r.t. the pixels they actually contain
+        tile_heights = np.minimum(tile_size, tissue_mask.shape[0] - np.arange(rows) * tile_size)
+        tile_widths = np.minimum(tile_size, tissue_mask.shape[1] - np.arange(cols) * tile_size)
+        tissue_coverage = (self.count_nonzero_per_tile(tissue_mask, tile_size, rows, cols) /
+                           np.outer(tile_heights, tile_widths))
 
         if self.annotation_dict is not None:
-            annotation_mask = np.zeros(shape=(tissue_mask.shape[0], tissue_mask.shape[1]))
+            annotation_mask = np.zeros(shape=(tissue_mask.shape[0], tissue_mask.shape[1]), dtype=np.uint8)
             scaling_factor = self.slide.level_downsamples[level]
             scaled_list = [
                 [[point[0] / scaling_factor, point[1] / scaling_factor]
@@ -251,139 +425,93 @@ class WSIHandler:
             for polygon in scaled_list:
                 cv2.fillPoly(annotation_mask, [np.array(polygon).astype(np.int32)], 1)
 
-        relevant_tiles_dict = {}
-        tile_nb = 0
-
-        # +1 to solve border issues
-        for row in range(rows):
-            for col in range(cols):
-
-                tile = tissue_mask[
-                       row * tile_size: row * tile_size + tile_size, col * tile_size: col * tile_size + tile_size
-                       ]
-                tissue_coverage = np.count_nonzero(tile) / tile.size
-                annotated = False
+            annotated = self.count_nonzero_per_tile(annotation_mask, tile_size, rows, cols) > 0
+        else:
+            annotated = np.zeros(shape=(rows, cols), dtype=bool)
 
-                if self.annotation_dict is not None:
-                    if (np.count_nonzero(annotation_mask[row * tile_size: row * tile_size + tile_size,
-                                         col * tile_size: col * tile_size + tile_size, ]) > 0):
-                        annotated = True
-
-                if (tissue_coverage >= min_coverage or
-                        (self.config["keep_annotated_tiles_despite_too_little_tissue_coverage"] and annotated)):
-                    relevant_tiles_dict.update(
-                        {
-                            tile_nb: {
-                                "x": col * tile_size,
-                                "y": row * tile_size,
-                                "size": tile_size,
-                                "level": level,
-                                "annotated": annotated,
-                            }
-                        }
-                    )
-                    if self.config["use_tissue_detection"]:
-                        if annotated:
-                            colored = cv2.rectangle(
-                                colored,
-                                (col * tile_size, row * tile_size),
-                                (col * tile_size + tile_size, row * tile_size + tile_size),
-                                (0, 255, 0),
-                                3,
-                            )
-                        else:
-                            colored = cv2.rectangle(
-                                colored,
-                                (col * tile_size, row * tile_size),
-                                (col * tile_size + tile_size, row * tile_size + tile_size),
-                                (255, 0, 0),
-                                1,
-                            )
+        relevant = tissue_coverage >= min_coverage
+        if self.config["keep_annotated_tiles_despite_too_little_tissue_coverage"]:
+            relevant |= annotated
 
-                    tile_nb += 1
+        relevant_tiles_dict = {}
+        # np.argwhere returns the tiles in row-major order, i.e. the tile numbering is the same as when iterating over
+        # rows and columns
+        for tile_nb, (row, col) in enumerate(np.argwhere(relevant)):
+            relevant_tiles_dict.update(
+                {
+                    tile_nb: {
+                        "x": int(col) * tile_size,
+                        "y": int(row) * tile_size,
+                        "size": tile_size,
+                        "level": level,
+                        "annotated": bool(annotated[row, col]),
+                    }
+                }
+            )
 
         if show and self.config["use_tissue_detection"]:
-            plt.imshow(colored)
-            plt.title("Tiled image")
-            plt.show()
+            self.show_relevant_tiles(tissue_mask, relevant_tiles_dict, tile_size)
 
         return relevant_tiles_dict
 
     @staticmethod
-    def tissue_percentage_over_threshold(label, label_dict, percentage):
-        if label_dict[label]["type"] == "==":
-            if label_dict[label]["threshold"] == percentage:
-                return label, percentage
-        elif label_dict[label]["type"] == ">=":
-            if percentage >= label_dict[label]["threshold"]:
-                return label, percentage
-        elif label_dict[label]["type"] == ">":
-            if percentage > label_dict[label]["threshold"]:
-                return label, percentage
-        elif label_dict[label]["type"] == "<=":
-            if percentage <= percentage[label]["threshold"]:
-                return label, percentage
-        elif label_dict[label]["type"] == "<":
-            if percentage < label_dict[label]["threshold"]:
-                return label, percentage
-
-        return None, None
+    @functools.lru_cache(maxsize=None)
+    def get_patch_positions(tile_size_px, patch_size_px, px_overlap):
+        # patches are placed every (patch_size_px - px_overlap) pixels, the last patch is aligned with the tile border.
+        # All tiles of a slide have the same size, so the positions are only computed once per overlap.
+        positions = range(0, tile_size_px - patch_size_px, patch_size_px - px_overlap)
+        return tuple(positions) + (tile_size_px - patch_size_px,)
 
     @staticmethod
-    def check_tissue_percentage_over_threshold(label, label_dict, percentage):
-        if label_dict[label]["type"] == "==":
-            if label_dict[label]["threshold"] == percentage:
-                return True
-        elif label_dict[label]["type"] == ">=":
-            if percentage >= label_dict[label]["threshold"]:
-                return True
-        elif label_dict[label]["type"] == ">":
-            if percentage > label_dict[label]["threshold"]:
-                return True
-        elif label_dict[label]["type"] == "<=":
-            if percentage <= percentage[label]["threshold"]:
-                return True
-        elif label_dict[label]["type"] == "<":
-            if percentage < label_dict[label]["threshold"]:
-                return True
-        return False
+    def sum_patch_windows(mask, patch_size_px_y, patch_size_px_x, patch_ys, patch_xs):
+        # summed-area table of the (boolean) tile mask like in count_nonzero_per_tile: the sum of every patch is given by
+        # four corners, so the memory needed does not grow with the patch overlap
+        integral = cv2.integral(mask.view(np.uint8))
+        patch_ys = np.asarray(patch_ys)
+        patch_xs = np.asarray(patch_xs)
+        top = integral[patch_ys]
+        bottom = integral[patch_ys + patch_size_px_y]
+        return (bottom[:, patch_xs + patch_size_px_x] - bottom[:, patch_xs] - top[:, patch_xs + patch_size_px_x] +
+                top[:, patch_xs])
+
+    def calculate_label_percentages(self, annotation_mask, patch_size_px_y, patch_size_px_x, patch_ys, patch_xs):
+        patch_area = patch_size_px_y * patch_size_px_x
+        if njit is not None:
+            return _count_patch_labels(annotation_mask, patch_size_px_y, patch_size_px_x, np.asarray(patch_ys),
+                                       np.asarray(patch_xs)) / patch_area
+
+        label_percentages = np.empty(shape=(annotation_mask.shape[2], len(patch_ys), len(patch_xs)))
+
+        # non-tumor tissue is unannotated tissue that's left after tissue detection
+        label_percentages[0] = self.sum_patch_windows(
+            ~annotation_mask.any(axis=2), patch_size_px_y, patch_size_px_x, patch_ys, patch_xs) / patch_area
+        for label_id in range(1, annotation_mask.shape[2]):
+            label_percentages[label_id] = self.sum_patch_windows(
+                annotation_mask[:, :, label_id] != 0, patch_size_px_y, patch_size_px_x, patch_ys, patch_xs) / patch_area
 
-    @staticmethod
-    def get_unique_nonzero_entries(ndarray):
-        return np.unique(ndarray[np.nonzero(ndarray)]).astype(int)
+        return label_percentages
 
-    def get_possible_labels(self, annotation_mask):
-        if self.get_unique_nonzero_entries(annotation_mask).size >= 1:
-            return self.get_unique_nonzero_entries(annotation_mask).tolist()
+    @staticmethod
+    def get_possible_labels(label_percentages):
+        label_ids = np.flatnonzero(label_percentages[1:]) + 1
+        if label_ids.size >= 1:
+            return label_ids.tolist()
         else:
             return [0]  # completely unlabeled patch -> only non-tumor
 
     @staticmethod
-    def is_non_tumor(label_ids):  # non-tumor tissue is unannotated tissue that's left after tissue detection
-        return label_ids[0] == 0
-
-    def calculate_label_percentages(self, label_ids, annotation_mask):
-        if self.is_non_tumor(label_ids):
-            label_percentages = [(np.count_nonzero(np.max(annotation_mask, axis=(-1)) == 0) /
-                                  annotation_mask[:, :, 0].size)]
-        else:
-            label_percentages = []
-            for label_id in label_ids:
-                label_percentages.append((np.count_nonzero(annotation_mask[:, :, label_id] == label_id) /
-                                          annotation_mask[:, :, label_id].size))
-        return label_percentages
-
-    def get_labels_with_enough_tissue_annotated(self, label_dict, annotation_mask):
-        label_ids = self.get_possible_labels(annotation_mask)
-        label_percentages = self.calculate_label_percentages(label_ids, annotation_mask)
-
-        labels_with_enough_tissue_including_non_tumor = []
-        for (label_id, label_percentage) in zip(label_ids, label_percentages):
-            label = list(label_dict)[label_id]
-            if self.check_tissue_percentage_over_threshold(label, label_dict, label_percentage):
-                labels_with_enough_tissue_including_non_tumor.append(label)
-
-        return labels_with_enough_tissue_including_non_tumor
+    def check_label_percentages_over_threshold(label_dict, label_percentages):
+        # one comparison per label for all patches of a tile instead of one call per label and patch
+        labels_over_threshold = np.zeros(shape=label_percentages.shape, dtype=bool)
+        for label_id, label_config in enumerate(label_dict.values()):
+            if label_config["type"] in _THRESHOLD_OPERATORS:
+                labels_over_threshold[label_id] = _THRESHOLD_OPERATORS[label_config["type"]](
+                    label_percentages[label_id], label_config["threshold"])
+        return labels_over_threshold
+
+    def get_labels_with_enough_tissue_annotated(self, label_names, label_percentages, labels_over_threshold):
+        label_ids = self.get_possible_labels(label_percentages)
+        return [label_names[label_id] for label_id in label_ids if labels_over_threshold[label_id]]
 
     def update_overlapping_annotations_file(self, slide_name, verbose):
         with open(os.path.join(self.config["output_path"],
@@ -399,20 +527,73 @@ class WSIHandler:
                 print(f"There are overlapping annotations in slide {slide_name}.")
 
     @staticmethod
-    def normalize_to_tile_size_px(point, tile_size_px):
-        if point < 0:
-            return 0
-        elif point >= tile_size_px:
-            return tile_size_px - 1.0
-        else:
-            return point
-
-    def translate_world_coordinates_to_tile_coordinates(self, point, tile_x, tile_y, tile_size_px):
+    def translate_world_coordinates_to_tile_coordinates(points, tile_x, tile_y, tile_size_px):
         # the shrinkage of the coordinates to tile size is necessary as cv2.fillPoly only works if the annotation is
         # completely within the tile, so I set any points larger than the tile coordinates to the closest (valid)
         # tile coordinates
-        return [self.normalize_to_tile_size_px(point[0] - tile_x, tile_size_px),
-                self.normalize_to_tile_size_px(point[1] - tile_y, tile_size_px)]
+        return np.clip(points - (tile_x, tile_y), 0, tile_size_px - 1.0)
+
+    @staticmethod
+    def save_patch(patch, file_path, output_format):
+        Image.fromarray(patch).save(file_path, format=output_format, **_SAVE_OPTIONS.get(output_format, {}))
+
+    @staticmethod
+    def wait_for_saved_patches(pending_saves):
+        # result() re-raises exceptions of the writer threads, so errors are still reported per slide
+        for future in pending_saves:
+            future.result()
+        pending_saves.clear()
+
+    @staticmethod
+    def get_annotated_tissue_types(label_dict):
+        annotated_tissue_types = {}
+        tissue_type_number = 1
+        for tissue_type, tissue_details in label_dict.items():
+            if tissue_details["annotated"]:
+                annotated_tissue_types.update({tissue_type: tissue_type_number})
+                tissue_type_number += 1
+        return annotated_tissue_types
+
+    def prepare_annotation_polygons(self, annotations, label_dict):
+        # done once per slide, so that the tile loop only needs to look up the polygons and their bounding boxes
+        annotated_tissue_types = self.get_annotated_tissue_types(label_dict)
+
+        polygons = []
+        for polygon in annotations:
+            coordinates = np.asarray(annotations[polygon]["coordinates"], dtype=float)
+            polygons.append({
+                "coordinates": coordinates,
+                "tissue_type_number": annotated_tissue_types[annotations[polygon]["tissue_type"]],
+                "min": coordinates.min(axis=0),
+                "max": coordinates.max(axis=0),
+            })
+        return polygons
+
+    def create_tile_annotation_mask(self, polygons, tile_x, tile_y, tile_size_px):
+        tile_annotation_mask = np.zeros(shape=(tile_size_px, tile_size_px, len(self.config["label_dict"])),
+                                        dtype=np.uint8)
+
+        for polygon in polygons:
+            # polygons that do not intersect the tile are skipped instead of being squashed onto the tile border
+            if (polygon["max"][0] < tile_x or polygon["max"][1] < tile_y or
+                    polygon["min"][0] >= tile_x + tile_size_px or polygon["min"][1] >= tile_y + tile_size_px):
+                continue
+
+            # Translate from world coordinates to tile coordinates
+            tile_polygon = self.translate_world_coordinates_to_tile_coordinates(polygon["coordinates"], tile_x, tile_y,
+                                                                                tile_size_px)
+            tissue_type_number = polygon["tissue_type_number"]
+
+            # note: the casting to a contiguous array is due to OpenCV requiring C-order (row major) for
+            # implementation purposes, compare the answer by vvolhejn here
+            # https://stackoverflow.com/questions/23830618/python-opencv-typeerror-layout-of-the-output-array-incompatible-with-cvmat
+            # basically: many (all?) copy operations in numpy do this, ascontiguousarray is one of the more
+            # verbose ones
+            tile_annotation_mask[:, :, tissue_type_number] = (
+                cv2.fillPoly(np.ascontiguousarray(tile_annotation_mask[:, :, tissue_type_number]),
+                             [tile_polygon.astype(np.int32)], tissue_type_number))
+
+        return tile_annotation_mask
 
     def extract_calibrated_patches(
             self,
@@ -423,102 +604,73 @@ class WSIHandler:
             overlap=0,
             annotation_overlap=0,
             slide_name=None,
-            output_format="png",
+            output_format="jpeg",
     ):
 
         scaling_factor = int(self.slide.level_downsamples[level])
 
-        patch_dict = {}
-        patch_nb = 0
-        for tile_key in tile_dict:
-            tile_x = tile_dict[tile_key]["x"] * scaling_factor
-            tile_y = tile_dict[tile_key]["y"] * scaling_factor
+        # struct of arrays, one list per metadata field instead of one dictionary per patch
+        patch_columns = {"slide_name": [], "tile_id": [], "patch_path": [], "label": [], "x_pos": [], "y_pos": [],
+                         "patch_size": [], "resized": []}
+        pending_saves = []
 
-            tile_size_px = tile_dict[tile_key]["size"] * scaling_factor
+        if annotations is not None:
+            polygons = self.prepare_annotation_polygons(annotations, label_dict)
+            label_names = list(label_dict)
 
-            patch_size_px_x = int(np.round(self.config["calibration"]["patch_size_microns"] / self.res_x))
-            patch_size_px_y = int(np.round(self.config["calibration"]["patch_size_microns"] / self.res_y))
+        tile_coordinates = [(tile_dict[tile_key]["x"] * scaling_factor, tile_dict[tile_key]["y"] * scaling_factor,
+                             tile_dict[tile_key]["size"] * scaling_factor) for tile_key in tile_dict]
 
-            tile = np.array(self.slide.read_region((tile_x, tile_y), level=0, size=(tile_size_px, tile_size_px)))
-            tile = tile[:, :, 0:3]
+        pool = ThreadPoolExecutor(max_workers=self.get_threads_per_process())
+        try:
+            for tile_key, (tile_x, tile_y, tile_size_px), tile in zip(tile_dict, tile_coordinates,
+                                                                      self.read_tiles(tile_coordinates)):
+                patch_size_px_x = int(np.round(self.config["calibration"]["patch_size_microns"] / self.res_x))
+                patch_size_px_y = int(np.round(self.config["calibration"]["patch_size_microns"] / self.res_y))
 
-            if tile_dict[tile_key]["annotated"]:
-                px_overlap_x = int(patch_size_px_x * annotation_overlap)
-                px_overlap_y = int(patch_size_px_y * annotation_overlap)
+                # the patches of the previous tile are written while this tile is processed, but not longer, so that at
+                # most two tiles worth of patches are kept in memory
+                self.wait_for_saved_patches(pending_saves)
 
-            else:
-                px_overlap_x = int(patch_size_px_x * overlap)
-                px_overlap_y = int(patch_size_px_y * overlap)
-
-            rows = int(np.ceil(tile_size_px / (patch_size_px_y - px_overlap_y)))
-            cols = int(np.ceil(tile_size_px / (patch_size_px_x - px_overlap_x)))
-
-            # create annotation mask
-            if annotations is not None:
-                # Translate from world coordinates to tile coordinates
-                tile_annotation_list = [
-                    [self.translate_world_coordinates_to_tile_coordinates(point, tile_x, tile_y, tile_size_px)
-                     for point in annotations[polygon]["coordinates"]] for polygon in annotations]
-
-                tile_annotation_list = list(zip(tile_annotation_list, [annotations[polygon]["tissue_type"]
-                                                                       for polygon in annotations]))
-
-                # Create mask from polygons
-                tile_annotation_mask = np.zeros(shape=(tile_size_px, tile_size_px, len(self.config["label_dict"])))
-
-                annotated_tissue_types = {}
-                tissue_type_number = 1
-                for tissue_type, tissue_details in label_dict.items():
-                    if tissue_details["annotated"]:
-                        annotated_tissue_types.update({tissue_type: tissue_type_number})
-                        tissue_type_number += 1
-
-                for polygon in tile_annotation_list:
-                    # note: the casting to a contiguous array is due to OpenCV requiring C-order (row major) for
-                    # implementation purposes, compare the answer by vvolhejn here
-                    # https://stackoverflow.com/questions/23830618/python-opencv-typeerror-layout-of-the-output-array-incompatible-with-cvmat
-                    # basically: many (all?) copy operations in numpy do this, ascontiguousarray is one of the more
-                    # verbose ones
-                    tile_annotation_mask[:, :, annotated_tissue_types[polygon[1]]] = (
-                        cv2.fillPoly(np.ascontiguousarray(
-                            tile_annotation_mask[:, :, annotated_tissue_types[polygon[1]]]),
-                            [np.array(polygon[0]).astype(np.int32)], annotated_tissue_types[polygon[1]]))
-
-            stop_y = False
-
-            for row in range(rows):
-                stop_x = False
-
-                for col in range(cols):
-
-                    # Calculate patch coordinates
-                    patch_x = int(col * (patch_size_px_x - px_overlap_x))
-                    patch_y = int(row * (patch_size_px_y - px_overlap_y))
-
-                    if patch_y + patch_size_px_y >= tile_size_px:
-                        stop_y = True
-                        patch_y = tile_size_px - patch_size_px_y
-
-                    if patch_x + patch_size_px_x >= tile_size_px:
-                        stop_x = True
-                        patch_x = tile_size_px - patch_size_px_x
-
-                    global_x = patch_x + tile_x
-                    global_y = patch_y + tile_y
-
-                    patch = tile[patch_y: patch_y + patch_size_px_y, patch_x: patch_x + patch_size_px_x, :]
-
-                    if np.sum(patch) == 0:
-                        break
-
-                    # check if the patch is annotated
-                    annotated = False
-
-                    if annotations is not None:
-                        patch_mask = tile_annotation_mask[patch_y: patch_y + patch_size_px_y,
-                                     patch_x: patch_x + patch_size_px_x, :]
-                        labels = self.get_labels_with_enough_tissue_annotated(label_dict, patch_mask)
-                        if labels is not None:
+                if tile_dict[tile_key]["annotated"]:
+                    px_overlap_x = int(patch_size_px_x * annotation_overlap)
+                    px_overlap_y = int(patch_size_px_y * annotation_overlap)
+
+                else:
+                    px_overlap_x = int(patch_size_px_x * overlap)
+                    px_overlap_y = int(patch_size_px_y * overlap)
+
+                patch_ys = self.get_patch_positions(tile_size_px, patch_size_px_y, px_overlap_y)
+                patch_xs = self.get_patch_positions(tile_size_px, patch_size_px_x, px_overlap_x)
+
+                # a row of patches is not processed any further after the first empty (black) patch
+                empty = self.sum_patch_windows(tile.any(axis=2), patch_size_px_y, patch_size_px_x, patch_ys,
+                                               patch_xs) == 0
+                skipped = np.logical_or.accumulate(empty, axis=1)
+
+                # create annotation mask
+                if annotations is not None:
+                    tile_annotation_mask = self.create_tile_annotation_mask(polygons, tile_x, tile_y, tile_size_px)
+                    label_percentages = self.calculate_label_percentages(tile_annotation_mask, patch_size_px_y,
+                                                                         patch_size_px_x, patch_ys, patch_xs)
+                    labels_over_threshold = self.check_label_percentages_over_threshold(label_dict, label_percentages)
+
+                for row, patch_y in enumerate(patch_ys):
+                    for col, patch_x in enumerate(patch_xs):
+                        if skipped[row, col]:
+                            break
+
+                        global_x = patch_x + tile_x
+                        global_y = patch_y + tile_y
+
+                        patch = tile[patch_y: patch_y + patch_size_px_y, patch_x: patch_x + patch_size_px_x, :]
+
+                        # check if the patch is annotated
+                        annotated = False
+
+                        if annotations is not None:
+                            labels = self.get_labels_with_enough_tissue_annotated(
+                                label_names, label_percentages[:, row, col], labels_over_threshold[:, row, col])
                             if len(labels) > 1:
                                 self.update_overlapping_annotations_file(
                                     slide_name, verbose=self.config["overlapping_annotations_verbose"])
@@ -528,10 +680,9 @@ class WSIHandler:
                                 if self.config["label_dict"][label]["annotated"]:
                                     annotated = True
 
-                    else:
-                        labels = "unlabeled"
+                        else:
+                            labels = ["unlabeled"]
 
-                    if labels is not None:
                         if self.annotated_only and annotated or not self.annotated_only:
 
                             file_name = slide_name + "_" + str(global_x) + "_" + str(global_y) + "." + output_format
@@ -539,47 +690,40 @@ class WSIHandler:
                             if self.config["calibration"]["resize"]:
                                 patch = cv2.resize(patch, (self.config["patch_size"], self.config["patch_size"]))
 
-                            patch = Image.fromarray(patch)
                             for label in labels:
-                                patch.save(os.path.join(self.output_path, label, file_name), format=output_format)
-
-                                patch_dict.update(
-                                    {
-                                        patch_nb: {
-                                            "slide_name": slide_name,
-                                            "patch_path": os.path.join(label, file_name),
-                                            "label": label,
-                                            "x_pos": global_x,
-                                            "y_pos": global_y,
-                                            "patch_size": patch_size_px_x,
-                                            "resized": self.config["calibration"]["resize"],
-                                        }
-                                    }
-                                )
-                                patch_nb += 1
-                    if stop_x:
-                        break
-                if stop_y:
-                    break
-
-        return patch_dict
+                                pending_saves.append(pool.submit(
+                                    self.save_patch, patch, os.path.join(self.output_path, label, file_name),
+                                    output_format))
+
+                                patch_columns["slide_name"].append(slide_name)
+                                patch_columns["tile_id"].append(tile_key)
+                                patch_columns["patch_path"].append(os.path.join(label, file_name))
+                                patch_columns["label"].append(label)
+                                patch_columns["x_pos"].append(global_x)
+                                patch_columns["y_pos"].append(global_y)
+                                patch_columns["patch_size"].append(patch_size_px_x)
+                                patch_columns["resized"].append(self.config["calibration"]["resize"])
+
+            self.wait_for_saved_patches(pending_saves)
+        finally:
+            # also on errors, so that no patches of a failed slide are written after it has been logged
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        return patch_columns
 
     def make_dirs(self, output_path, slide_name, label_dict, annotated):
         try:
+            # all label directories are created once per slide here, the patch extraction relies on them to exist
             slide_path = os.path.join(output_path, slide_name)
-            if not os.path.exists(slide_path):
-                os.makedirs(slide_path)
             if not annotated:
-                unlabeled_path = os.path.join(slide_path, "unlabeled")
-                if not os.path.exists(unlabeled_path):
-                    os.makedirs(unlabeled_path)
+                os.makedirs(os.path.join(slide_path, "unlabeled"), exist_ok=True)
             else:
                 for label in label_dict:
                     sub_path = os.path.join(slide_path, label)
-                    if not os.path.exists(sub_path):
-                        os.makedirs(sub_path)
-                    for patch in os.listdir(sub_path):
-                        os.remove(os.path.join(sub_path, patch))
+                    os.makedirs(sub_path, exist_ok=True)
+                    with os.scandir(sub_path) as patches:
+                        for patch in patches:
+                            os.remove(patch.path)
             self.output_path = slide_path
 
         except Exception as e:
@@ -595,177 +739,160 @@ class WSIHandler:
             annotation_overlap=0,
             patch_size=256,
             slide_name=None,
-            output_format="png",
+            output_format="jpeg",
     ):
-        patch_dict = {}
+        # struct of arrays, one list per metadata field instead of one dictionary per patch
+        patch_columns = {"slide_name": [], "tile_id": [], "patch_path": [], "label": [], "x_pos": [], "y_pos": [],
+                         "patch_size": []}
 
         scaling_factor = int(self.slide.level_downsamples[level])
         patch_nb = 0
+        pending_saves = []
 
-        for tile_key in tile_dict:
-            # skip unannotated tiles in case only annotated patches should be saved
-            if self.annotated_only and not tile_dict[tile_key]["annotated"]:
-                pass
-            else:
-                # ToDo: rows and cols arent calculated correctly, instead a quick fix by using breaks was applied
+        if annotations is not None:
+            polygons = self.prepare_annotation_polygons(annotations, label_dict)
+            label_names = list(label_dict)
 
-                tile_x = tile_dict[tile_key]["x"] * scaling_factor
-                tile_y = tile_dict[tile_key]["y"] * scaling_factor
-                tile_size = tile_dict[tile_key]["size"] * scaling_factor
-                tile = np.array(self.slide.read_region((tile_x, tile_y), level=0, size=(tile_size, tile_size)))
-                tile = tile[:, :, 0:3]
+        # skip unannotated tiles in case only annotated patches should be saved
+        tile_keys = [tile_key for tile_key in tile_dict
+                     if not self.annotated_only or tile_dict[tile_key]["annotated"]]
+        tile_coordinates = [(tile_dict[tile_key]["x"] * scaling_factor, tile_dict[tile_key]["y"] * scaling_factor,
+                             tile_dict[tile_key]["size"] * scaling_factor) for tile_key in tile_keys]
+
+        pool = ThreadPoolExecutor(max_workers=self.get_threads_per_process())
+        try:
+            for tile_key, (tile_x, tile_y, tile_size), tile in zip(tile_keys, tile_coordinates,
+                                                                   self.read_tiles(tile_coordinates)):
+                # the patches of the previous tile are written while this tile is processed, but not longer, so that at
+                # most two tiles worth of patches are kept in memory
+                self.wait_for_saved_patches(pending_saves)
 
                 # overlap separately  for annotated and unannotated patches
                 if tile_dict[tile_key]["annotated"]:
                     px_overlap = int(patch_size * annotation_overlap)
-                    rows = int(np.ceil(tile_size / (patch_size - px_overlap)))
-                    cols = int(np.ceil(tile_size / (patch_size - px_overlap)))
-
                 else:
                     px_overlap = int(patch_size * overlap)
-                    rows = int(np.ceil(tile_size / (patch_size - px_overlap)))
-                    cols = int(np.ceil(tile_size / (patch_size - px_overlap)))
+
+                patch_positions = self.get_patch_positions(tile_size, patch_size, px_overlap)
+
+                # a row of patches is not processed any further after the first empty (black) patch
+                empty = self.sum_patch_windows(tile.any(axis=2), patch_size, patch_size, patch_positions,
+                                               patch_positions) == 0
+                skipped = np.logical_or.accumulate(empty, axis=1)
 
                 # create annotation mask
                 if annotations is not None:
-                    # Translate from world coordinates to tile coordinates
-                    tile_annotation_list = [
-                        [self.translate_world_coordinates_to_tile_coordinates(point, tile_x, tile_y, tile_size)
-                         for point in annotations[polygon]["coordinates"]] for polygon in annotations]
-
-                    tile_annotation_list = list(zip(tile_annotation_list, [annotations[polygon]["tissue_type"]
-                                                                           for polygon in annotations]))
-
-                    # Create mask from polygons
-                    tile_annotation_mask = np.zeros(shape=(tile_size, tile_size, len(self.config["label_dict"])))
-
-                    annotated_tissue_types = {}
-                    tissue_type_number = 1
-                    for tissue_type, tissue_details in label_dict.items():
-                        if tissue_details["annotated"]:
-                            annotated_tissue_types.update({tissue_type: tissue_type_number})
-                            tissue_type_number += 1
-
-                    for polygon in tile_annotation_list:
-                        # note: the casting to a contiguous array is due to OpenCV requiring C-order (row major) for
-                        # implementation purposes, compare the answer by vvolhejn here
-                        # https://stackoverflow.com/questions/23830618/python-opencv-typeerror-layout-of-the-output-array-incompatible-with-cvmat
-                        # basically: many (all?) copy operations in numpy do this, ascontiguousarray is one of the more
-                        # verbose ones
-                        tile_annotation_mask[:, :, annotated_tissue_types[polygon[1]]] = (
-                            cv2.fillPoly(np.ascontiguousarray(
-                                tile_annotation_mask[:, :, annotated_tissue_types[polygon[1]]]),
-                                [np.array(polygon[0]).astype(np.int32)], annotated_tissue_types[polygon[1]]))
-
-                stop_y = False
-
-                for row in range(rows):
-                    stop_x = False
-
-                    for col in range(cols):
-
-                        # Calculate patch coordinates
-                        patch_x = int(col * (patch_size - px_overlap))
-                        patch_y = int(row * (patch_size - px_overlap))
-
-                        if patch_y + patch_size >= tile_size:
-                            stop_y = True
-                            patch_y = tile_size - patch_size
-
-                        if patch_x + patch_size >= tile_size:
-                            stop_x = True
-                            patch_x = tile_size - patch_size
+                    tile_annotation_mask = self.create_tile_annotation_mask(polygons, tile_x, tile_y, tile_size)
+                    label_percentages = self.calculate_label_percentages(tile_annotation_mask, patch_size, patch_size,
+                                                                         patch_positions, patch_positions)
+                    labels_over_threshold = self.check_label_percentages_over_threshold(label_dict, label_percentages)
+
+                for row, patch_y in enumerate(patch_positions):
+                    for col, patch_x in enumerate(patch_positions):
+                        if skipped[row, col]:
+                            break
 
                         global_x = patch_x + tile_x
                         global_y = patch_y + tile_y
 
                         patch = tile[patch_y: patch_y + patch_size, patch_x: patch_x + patch_size, :]
 
-                        if np.sum(patch) == 0:
-                            break
-
                         # check if the patch is annotated
                         annotated = False
                         if annotations is not None:
-                            patch_mask = tile_annotation_mask[
-                                         patch_y: patch_y + patch_size, patch_x: patch_x + patch_size
-                                         ]
-
-                            labels = self.get_labels_with_enough_tissue_annotated(label_dict, patch_mask)
-                            if labels is not None:
-                                if len(labels) > 1:
-                                    self.update_overlapping_annotations_file(
-                                        slide_name, verbose=self.config["overlapping_annotations_verbose"])
-
-                                for label in labels:
-                                    # this check is done to ensure that non-tumor tissue (unannotated) is handled
-                                    # properly
-                                    if self.config["label_dict"][label]["annotated"]:
-                                        annotated = True
+                            labels = self.get_labels_with_enough_tissue_annotated(
+                                label_names, label_percentages[:, row, col], labels_over_threshold[:, row, col])
+                            if len(labels) > 1:
+                                self.update_overlapping_annotations_file(
+                                    slide_name, verbose=self.config["overlapping_annotations_verbose"])
+
+                            for label in labels:
+                                # this check is done to ensure that non-tumor tissue (unannotated) is handled properly
+                                if self.config["label_dict"][label]["annotated"]:
+                                    annotated = True
 
                         else:
-                            labels = "unlabeled"
-
-                        if labels is not None:
-                            if self.annotated_only and annotated or not self.annotated_only:
-                                if slide_name is not None:
-
-                                    file_name = (
-                                            slide_name + "_" + str(global_x) + "_" + str(global_y) + "." + output_format
-                                    )
-                                else:
-                                    file_name = (
-                                            str(patch_nb) + "_" + str(global_x) + "_" + str(global_y) + "." +
-                                            output_format
-                                    )
-
-                                patch = Image.fromarray(patch)
-
-                                for label in labels:
-                                    patch.save(os.path.join(self.output_path, label, file_name), format=output_format)
-
-                                    patch_dict.update(
-                                        {
-                                            patch_nb: {
-                                                "slide_name": slide_name,
-                                                "patch_path": os.path.join(label, file_name),
-                                                "label": label,
-                                                "x_pos": global_x,
-                                                "y_pos": global_y,
-                                                "patch_size": patch_size,
-                                            }
-                                        }
-                                    )
-                                    patch_nb += 1
-                        if stop_x:
-                            break
-                    if stop_y:
-                        break
+                            labels = ["unlabeled"]
 
-        return patch_dict
+                        if self.annotated_only and annotated or not self.annotated_only:
+                            if slide_name is not None:
+
+                                file_name = (
+                                        slide_name + "_" + str(global_x) + "_" + str(global_y) + "." + output_format
+                                )
+                            else:
+                                file_name = (
+                                        str(patch_nb) + "_" + str(global_x) + "_" + str(global_y) + "." +
+                                        output_format
+                                )
+
+                            for label in labels:
+                                pending_saves.append(pool.submit(
+                                    self.save_patch, patch, os.path.join(self.output_path, label, file_name),
+                                    output_format))
+
+                                patch_columns["slide_name"].append(slide_name)
+                                patch_columns["tile_id"].append(tile_key)
+                                patch_columns["patch_path"].append(os.path.join(label, file_name))
+                                patch_columns["label"].append(label)
+                                patch_columns["x_pos"].append(global_x)
+                                patch_columns["y_pos"].append(global_y)
+                                patch_columns["patch_size"].append(patch_size)
+                                patch_nb += 1
+
+            self.wait_for_saved_patches(pending_saves)
+        finally:
+            # also on errors, so that no patches of a failed slide are written after it has been logged
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        return patch_columns
 
     def export_dict(self, dictionary, metadata_format, filename):
 
         if metadata_format == "json":
             file = os.path.join(self.output_path, filename + ".json")
-            with open(file, "w") as json_file:
-                json.dump(dictionary, json_file, indent=4)
-        elif metadata_format == "csv":
-            df = pd.DataFrame(dictionary.values())
+            # the metadata is written compact with both backends, so that the files do not depend on orjson being
+            # installed (orjson only supports an indent of 2)
+            if orjson is not None:
+                # the patch dictionaries use integer keys, which orjson only serializes with OPT_NON_STR_KEYS
+                with open(file, "wb") as json_file:
+                    json_file.write(orjson.dumps(dictionary, option=orjson.OPT_NON_STR_KEYS))
+            else:
+                with open(file, "w", encoding="utf-8") as json_file:
+                    json.dump(dictionary, json_file, separators=(",", ":"), ensure_ascii=False)
+        else:
+            self.export_dataframe(pd.DataFrame(dictionary.values()), metadata_format, filename)
+
+    def export_columns(self, columns, metadata_format, filename):
+        # only the json export needs one dictionary per row, csv and parquet are written column-wise
+        if metadata_format == "json":
+            rows = {row_nb: dict(zip(columns, values)) for row_nb, values in enumerate(zip(*columns.values()))}
+            self.export_dict(rows, metadata_format, filename)
+        else:
+            self.export_dataframe(pd.DataFrame(columns), metadata_format, filename)
+
+    def export_dataframe(self, df, metadata_format, filename):
+
+        if metadata_format == "csv":
             file = os.path.join(self.output_path, filename + ".csv")
             df.to_csv(file, index=False)
+        elif metadata_format == "parquet":
+            # requires pyarrow (or fastparquet) to be installed
+            file = os.path.join(self.output_path, filename + ".parquet")
+            df.to_parquet(file, index=False)
         else:
-            print("Could not write metadata. Metadata format has to be json or csv")
+            print("Could not write metadata. Metadata format has to be json, csv or parquet")
 
-    def save_thumbnail(self, mask, slide_name, level, output_format="png"):
+    def save_thumbnail(self, mask, slide_name, level, output_format="jpeg", image=None):
 
         remap_color = ((0, 0, 0), (255, 255, 255))
 
-        process_level = level
-        img = self.slide.read_region([0, 0], process_level, self.slide.level_dimensions[process_level])
+        if image is None:
+            process_level = level
+            image = np.array(self.slide.read_region([0, 0], process_level, self.slide.level_dimensions[process_level]))
 
         # Remove Alpha
-        img = np.array(img)[:, :, 0:3]
+        img = image[:, :, 0:3]
 
         if remap_color is not None:
             indizes = np.all(img == remap_color[0], axis=2)
@@ -779,7 +906,7 @@ class WSIHandler:
             img = median_filtered_img
 
         file_name = os.path.join(self.config["output_path"], slide_name, "thumbnail." + output_format)
-        plt.imsave(file_name, img, format=output_format)
+        Image.fromarray(img).save(file_name, format=output_format)
 
     def init_generic_tiff(self):
 
@@ -844,7 +971,7 @@ class WSIHandler:
             if os.path.exists(annotation_path):
 
                 annotated = True
-                self.annotation_dict = self.load_annotation(annotation_path)
+                self.annotation_dict = self.load_annotation(annotation_path, tuple(self.config["label_dict"]))
             else:
                 annotated = False
                 self.annotation_dict = None
@@ -876,8 +1003,10 @@ class WSIHandler:
 
         if self.config["use_tissue_detection"]:
             mask, level = self.apply_tissue_detection(level=level, show=self.config["show_mode"])
+            thumbnail_image = self.tissue_detection_image
         else:
             mask = np.ones(shape=self.slide.level_dimensions[level]).transpose()
+            thumbnail_image = None
         try:
             tile_size = self.determine_tile_size(level)
         except Exception as e:
@@ -898,7 +1027,7 @@ class WSIHandler:
         # Calibrated or non calibrated patch sizes
         if self.config["calibration"]["use_non_pixel_lengths"]:
             try:
-                patch_dict = self.extract_calibrated_patches(
+                patch_columns = self.extract_calibrated_patches(
                     tile_dict,
                     level,
                     self.annotation_dict,
@@ -913,7 +1042,7 @@ class WSIHandler:
                 return 0
         else:
             try:
-                patch_dict = self.extract_patches(
+                patch_columns = self.extract_patches(
                     tile_dict,
                     level,
                     self.annotation_dict,
@@ -928,10 +1057,13 @@ class WSIHandler:
                 self.print_and_log_slide_error(slide_name, e, "extract_patches")
                 return 0
 
-        self.export_dict(patch_dict, self.config["metadata_format"], "tile_information")
+        self.export_columns(patch_columns, self.config["metadata_format"], "tile_information")
+        # tile_id links the patches in tile_information to their tile
+        self.export_dict({tile_key: {"tile_id": tile_key, **tile} for tile_key, tile in tile_dict.items()},
+                         self.config["metadata_format"], "relevant_tiles")
         try:
             self.save_thumbnail(mask, level=level, slide_name=slide_name,
-                                output_format=self.config["output_format"])
+                                output_format=self.config["output_format"], image=thumbnail_image)
             print("Finished slide ", slide_name)
 
         except Exception as e:
@@ -959,9 +1091,12 @@ class WSIHandler:
         return slide_list
 
     @staticmethod
-    def init(l):
+    def init(l, numba_threads):
         global lock
         lock = l
+        # the parallel numba kernel would otherwise start one thread per core in every pool process
+        if set_num_threads is not None:
+            set_num_threads(numba_threads)
 
     @staticmethod
     def get_slide_name_from_slide_path(slide_path):
@@ -1027,10 +1162,13 @@ class WSIHandler:
 
             if _MULTIPROCESS:
                 available_threads = multiprocessing.cpu_count() - self.config["blocked_threads"]
-                pool = multiprocessing.Pool(processes=available_threads, initializer=self.init, initargs=(l,))
+                pool = multiprocessing.Pool(processes=available_threads, initializer=self.init,
+                                            initargs=(l, self.get_threads_per_process()))
                 pool.map(self.process_slide, slide_list)
 
             else:
+                if set_num_threads is not None:
+                    set_num_threads(self.get_threads_per_process())
                 for slide in slide_list:
                     self.process_slide(slide)
 
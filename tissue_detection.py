@@ -9,8 +9,9 @@ def tissue_detection(img, remove_top_percentage=0.2):
 
     kernel_size = 3
 
-    # remove alpha channel
-    img = img[:, :, 0:3]
+    # remove alpha channel, the copy leaves the image of the caller unchanged (OpenCV would copy the non-contiguous
+    # view for the median filter anyway)
+    img = img[:, :, 0:3].copy()
 
     top_border = int(len(img)*remove_top_percentage)
     # hack for removing border artifacts
@@ -33,7 +34,8 @@ def tissue_detection(img, remove_top_percentage=0.2):
     _, threshold_image = cv2.threshold(saturation, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
 
     # apply dilation to image to close spots inside mask regions
-    kernel = np.ones(shape=(kernel_size, kernel_size))
+    # uint8 rectangular structuring element, a float kernel keeps OpenCV from using its fast separable dilation
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
     tissue_mask = cv2.dilate(threshold_image, kernel, iterations=1)
     # tissue_mask = cv2.erode(tissue_mask, kernel)
 